@@ -0,0 +1,335 @@
+"""
+====================================================
+Búsqueda distribuida en una base de datos de
+referencia dividida en fragmentos. Cada fragmento
+es atendido por un trabajador de larga duración
+(en otro equipo o en el mismo) y un coordinador
+reparte la consulta y combina los mejores resultados.
+
+Uso:
+    python Fragmentos.py dividir RRUFF.db 4
+    python Fragmentos.py servir Fragmentos/RRUFF_0.db 5000 [host]
+    python Fragmentos.py buscar espectro.CSV SG [--timeout 600] host1:5000 host2:5000
+====================================================
+"""
+
+# Importamos las funciones y librerías necesarias
+from Funcion import *
+import importlib
+import json
+import select
+from functools import partial
+import socket
+import socketserver
+import sys
+
+# Módulo y función de comparación de cada método
+METODOS = {
+    'SG': ('Savitzky_Golay', 'comparar_SG'),
+    'airPLS': ('airPLS', 'comparar_airPLS')
+}
+# Tiempo máximo de espera por trabajador en segundos
+TIEMPO_ESPERA = 600.0
+# Registros del fragmento en cada proceso trabajador
+_datos = None
+
+
+def dividir_bd(ruta, n_fragmentos, destino='Fragmentos'):
+    """
+    Función que divide una base de datos en fragmentos de costo
+    similar, cada uno con la misma tabla RRUFF que la original.
+
+    Parametros
+    ----------
+    ruta : str
+        ruta de la base de datos
+    n_fragmentos : int
+        Número de fragmentos a generar.
+    destino : str
+        Directorio donde se guardan los fragmentos.
+
+    Returns
+    -------
+    rutas : list
+        Rutas de los fragmentos generados.
+    """
+    conn = sqlite3.connect(ruta, detect_types=sqlite3.PARSE_DECLTYPES)
+    c = conn.cursor()
+    # Esquema de la tabla para replicarlo en cada fragmento
+    c.execute("SELECT sql FROM sqlite_master WHERE name='RRUFF'")
+    esquema = c.fetchone()[0]
+    # Primera pasada: ancho del dominio de cada registro, uno a la vez.
+    # Con un espectro de entrada de muestreo uniforme, el número de sus
+    # puntos dentro del dominio (ver costo_registros) es proporcional
+    # a este ancho.
+    ids = []
+    costos = []
+    for fila in c.execute("SELECT rowid, * FROM RRUFF"):
+        ids.append(fila[0])
+        costos.append(np.amax(fila[2]) - np.amin(fila[2]))
+    conn.close()
+    bloques = bloques_balanceados(range(len(ids)), costos, n_fragmentos)
+    fragmento = {}
+    for n, bloque in enumerate(bloques):
+        for i in bloque:
+            fragmento[ids[i]] = n
+    # Segunda pasada: copiamos los registros sin convertir los arreglos
+    Path(destino).mkdir(parents=True, exist_ok=True)
+    rutas = [str(Path(destino) / 'RRUFF_{}.db'.format(n))
+             for n in range(len(bloques))]
+    salidas = [sqlite3.connect(ruta_fragmento) for ruta_fragmento in rutas]
+    for salida in salidas:
+        salida.execute("DROP TABLE IF EXISTS RRUFF")
+        salida.execute(esquema)
+    conn = sqlite3.connect(ruta)
+    for fila in conn.execute("SELECT rowid, * FROM RRUFF"):
+        marcas = ','.join('?' * (len(fila) - 1))
+        salidas[fragmento[fila[0]]].execute(
+            "INSERT INTO RRUFF VALUES ({})".format(marcas), fila[1:])
+    conn.close()
+    for salida in salidas:
+        salida.commit()
+        salida.close()
+    return rutas
+
+
+def _cargar_fragmento(datos):
+    # Inicialización de cada proceso trabajador del servidor
+    global _datos
+    _datos = datos
+
+
+def comparar_registro(metodo, x, y, i_registro):
+    """
+    Función que compara el espectro de entrada con un registro del
+    fragmento cargado en el proceso trabajador.
+
+    Returns
+    -------
+    corr : float
+    """
+    modulo, funcion = METODOS[metodo]
+    comparar = getattr(importlib.import_module(modulo), funcion)
+    return comparar(x, y, _datos[i_registro][1], _datos[i_registro][2])
+
+
+def buscar_fragmento(p, n_trabajadores, datos, x, y, metodo, k):
+    """
+    Función que compara un espectro contra los registros de un
+    fragmento y regresa los k mejores.
+
+    Parametros
+    ----------
+    p : multiprocessing.Pool
+        Pool cuyos procesos tienen cargado el fragmento (ver servir_fragmento).
+    n_trabajadores : int
+        Número de procesos del pool.
+    datos : list
+        Registros del fragmento, los mismos que tienen los procesos.
+
+    Returns
+    -------
+    mejores : list
+        Pares (correlación, nombre) ordenados de mayor a menor.
+    """
+    if metodo not in METODOS:
+        raise ValueError('Método desconocido: {}'.format(metodo))
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    costos = costo_registros(x, datos, metodo)
+    correlaciones, uso = mapear_por_costo(p, partial(comparar_registro, metodo, x, y),
+                                          costos, n_trabajadores, 'bloques')
+    validos = [(float(corr), i) for i, corr in enumerate(correlaciones)
+               if np.isfinite(corr)]
+    return [(corr, datos[i][0]) for corr, i in heapq.nlargest(k, validos)]
+
+
+def _cliente_conectado(conexion):
+    """
+    Función que revisa, sin bloquear, si el cliente de una conexión
+    sigue conectado.
+    """
+    listo, _, _ = select.select([conexion], [], [], 0)
+    if not listo:
+        return True
+    try:
+        return conexion.recv(1, socket.MSG_PEEK) != b''
+    except OSError:
+        return False
+
+
+class _Atencion(socketserver.StreamRequestHandler):
+    """
+    Atiende solicitudes de búsqueda, una por línea en formato JSON:
+    {"metodo": "SG", "x": [...], "y": [...], "k": 10}
+    Responde con {"resultados": [[corr, nombre], ...], "tiempo": t}
+    o con {"error": mensaje}.
+
+    Cada fragmento atiende una sola consulta a la vez; las demás
+    conexiones esperan en cola. Las consultas cuyo cliente ya se
+    desconectó (por ejemplo, porque el coordinador agotó su tiempo de
+    espera) se descartan sin procesarlas, pero una consulta en curso
+    no se interrumpe si el cliente se desconecta.
+    """
+
+    def handle(self):
+        for linea in self.rfile:
+            if not _cliente_conectado(self.connection):
+                return
+            inicio = time.time()
+            try:
+                solicitud = json.loads(linea)
+                mejores = buscar_fragmento(self.server.p, self.server.n_trabajadores,
+                                           self.server.datos, solicitud['x'],
+                                           solicitud['y'], solicitud['metodo'],
+                                           solicitud.get('k', 10))
+                respuesta = {'resultados': mejores,
+                             'n_registros': len(self.server.datos),
+                             'tiempo': time.time() - inicio}
+            except Exception as error:
+                respuesta = {'error': '{}: {}'.format(type(error).__name__, error)}
+            try:
+                self.wfile.write((json.dumps(respuesta) + '\n').encode())
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                # El cliente se desconectó mientras se procesaba la consulta
+                return
+
+
+class _Servidor(socketserver.TCPServer):
+    # Permite reiniciar un trabajador en el mismo puerto aunque el
+    # socket anterior siga en TIME_WAIT
+    allow_reuse_address = True
+
+
+def servir_fragmento(ruta, puerto, host='localhost', n_trabajadores=None):
+    """
+    Función que carga un fragmento de la base de datos una sola vez
+    y atiende solicitudes de búsqueda en host:puerto hasta que se
+    interrumpe. Usar host='0.0.0.0' para aceptar conexiones de otros
+    equipos. Los procesos trabajadores se crean una sola vez con el
+    fragmento cargado y se reutilizan en todas las solicitudes.
+    """
+    datos = datos_RRUFF(ruta)
+    p, backend, n_trabajadores = crear_pool('procesos', n_trabajadores,
+                                            inicializar=_cargar_fragmento,
+                                            args=(datos,))
+    servidor = _Servidor((host, puerto), _Atencion)
+    servidor.datos = datos
+    servidor.p = p
+    servidor.n_trabajadores = n_trabajadores
+    print('Fragmento {} ({} registros) en {}:{} con {} procesos'.format(
+        ruta, len(datos), host, puerto, n_trabajadores))
+    try:
+        servidor.serve_forever()
+    finally:
+        servidor.server_close()
+        p.terminate()
+        p.join()
+
+
+def consultar_fragmento(direccion, solicitud, timeout=None):
+    """
+    Función que envía una solicitud de búsqueda a un trabajador.
+
+    Parametros
+    ----------
+    direccion : str
+        Dirección del trabajador en formato host:puerto.
+    solicitud : dict
+        Solicitud de búsqueda (ver _Atencion).
+
+    Returns
+    -------
+    respuesta : dict
+    """
+    host, puerto = direccion.rsplit(':', 1)
+    with socket.create_connection((host, int(puerto)), timeout) as conexion:
+        conexion.sendall((json.dumps(solicitud) + '\n').encode())
+        return json.loads(conexion.makefile('rb').readline())
+
+
+def buscar_distribuido(x, y, direcciones, metodo='SG', k=10,
+                       timeout=TIEMPO_ESPERA):
+    """
+    Función que reparte una búsqueda entre los trabajadores de cada
+    fragmento y combina sus k mejores resultados.
+
+    Parametros
+    ----------
+    x, y : ndarray
+        Espectro a analizar.
+    direcciones : list
+        Direcciones host:puerto de los trabajadores.
+    metodo : str
+        Método de corrección por línea base ('SG' o 'airPLS').
+    k : int
+        Número de mejores resultados a regresar.
+    timeout : float
+        Tiempo máximo de espera por trabajador en segundos.
+        Un trabajador que no responde a tiempo se reporta como falla.
+
+    Returns
+    -------
+    mejores : list
+        Pares (correlación, nombre) ordenados de mayor a menor.
+    fallas : dict
+        Mensaje de error de cada trabajador que no respondió.
+    """
+    if not direcciones:
+        raise ValueError('Se necesita al menos una dirección host:puerto')
+    solicitud = {'metodo': metodo, 'x': np.asarray(x).tolist(),
+                 'y': np.asarray(y).tolist(), 'k': k}
+
+    def consultar(direccion):
+        try:
+            return consultar_fragmento(direccion, solicitud, timeout)
+        except (OSError, ValueError) as error:
+            return {'error': '{}: {}'.format(type(error).__name__, error)}
+
+    p = ThreadPool(len(direcciones))
+    respuestas = p.map(consultar, direcciones)
+    p.close()
+    p.join()
+    candidatos = []
+    fallas = {}
+    for direccion, respuesta in zip(direcciones, respuestas):
+        if 'error' in respuesta:
+            fallas[direccion] = respuesta['error']
+        else:
+            candidatos.extend(tuple(r) for r in respuesta['resultados'])
+    return heapq.nlargest(k, candidatos), fallas
+
+
+if __name__ == "__main__":
+    orden = sys.argv[1] if len(sys.argv) > 1 else ''
+    if orden == 'dividir':
+        for ruta in dividir_bd(sys.argv[2], int(sys.argv[3])):
+            print(ruta)
+    elif orden == 'servir':
+        # Host opcional, por omisión solo conexiones locales
+        host = sys.argv[4] if len(sys.argv) > 4 else 'localhost'
+        servir_fragmento(sys.argv[2], int(sys.argv[3]), host)
+    elif orden == 'buscar' and len(sys.argv) > 4:
+        direcciones = sys.argv[4:]
+        timeout = TIEMPO_ESPERA
+        if direcciones[0] == '--timeout':
+            if len(direcciones) < 2:
+                sys.exit(__doc__)
+            timeout = float(direcciones[1])
+            direcciones = direcciones[2:]
+        if not direcciones:
+            sys.exit(__doc__)
+        start = time.time()
+        X, Y = np.loadtxt(sys.argv[2], unpack=True, comments='##', delimiter=',')
+        mejores, fallas = buscar_distribuido(X, Y, direcciones, sys.argv[3],
+                                             timeout=timeout)
+        for direccion, error in fallas.items():
+            print('Sin respuesta de {}: {}'.format(direccion, error))
+        print("Tiempo transcurrido: %3.3f" % (time.time() - start)+" segundos")
+        print('=======================================')
+        print('Resultados\n')
+        for n, (corr, nombre) in enumerate(mejores):
+            print('%2d' % (n + 1) + '. ' + nombre + ' - %.4f' % corr)
+    else:
+        print(__doc__)
@@ -10,7 +10,10 @@
 """
 
 # Importamos las librerías necesarias
+import contextlib
+import heapq
 import io
+import os
 import sqlite3
 from scipy import interpolate
 from scipy.interpolate import interp1d
@@ -26,7 +29,14 @@ import time
 import tkinter as tk
 from tkinter import filedialog
 import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
+import threading
 from pathlib import Path
+# threadpoolctl es opcional; permite limitar los hilos de BLAS
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
 
 home = str(Path.home())
 params = {
@@ -301,3 +311,532 @@ def mycorr(x, y, xR, yR):
     return corr
 
 
+def puntaje_burdo(x, y, xR, yR, n_puntos=64):
+    """
+    Función que calcula un puntaje burdo de similitud entre dos
+    espectros sin corregir la línea base. Ambos espectros se
+    remuestrean a pocos puntos sobre el dominio que comparten.
+
+    Returns
+    -------
+    corr : float
+        Coeficiente de correlación burdo; -1 si los dominios no se traslapan.
+    """
+    # Dominio común a ambos espectros
+    lim_inf = max(np.amin(x), np.amin(xR))
+    lim_sup = min(np.amax(x), np.amax(xR))
+    if lim_sup <= lim_inf:
+        return -1.0
+    malla = np.linspace(lim_inf, lim_sup, n_puntos)
+    ym = np.interp(malla, x, y)
+    yRm = np.interp(malla, xR, yR)
+    # Evitamos dividir entre cero con espectros constantes
+    if np.std(ym) == 0 or np.std(yRm) == 0:
+        return 0.0
+    return np.corrcoef(ym, yRm)[0, 1]
+
+
+def cotas_superiores(x, y, datos, margen=None, n_puntos=64):
+    """
+    Función que calcula, para cada registro de la base de datos,
+    un puntaje burdo y una cota superior del coeficiente de
+    correlación final.
+
+    Parametros
+    ----------
+    margen : float
+        Holgura que se suma al puntaje burdo para obtener la cota.
+        Con None la cota es 1 para todos los registros (búsqueda exacta,
+        que solo termina antes por tiempo); con un valor numérico la
+        cota es heurística y permite terminar antes.
+
+    Returns
+    -------
+    burdo : ndarray
+        Puntaje burdo de cada registro, sirve para ordenar la búsqueda.
+    cotas : ndarray
+        Cota superior del coeficiente de correlación de cada registro.
+    """
+    burdo = np.array([puntaje_burdo(x, y, registro[1], registro[2], n_puntos)
+                      for registro in datos])
+    if margen is None:
+        cotas = np.ones(len(datos))
+    else:
+        cotas = np.minimum(1.0, burdo + margen)
+    return burdo, cotas
+
+
+class _Etiquetado:
+    """
+    Envuelve una función de comparación para que regrese también
+    el índice del registro procesado.
+    """
+
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, i_registro):
+        return i_registro, self.func(i_registro)
+
+
+def busqueda_progresiva(p, func, orden, cotas, k=10, tiempo_max=None,
+                        al_actualizar=None):
+    """
+    Función que compara los registros en el orden dado y mantiene
+    los k mejores coeficientes de correlación conforme llegan.
+    Termina antes cuando ningún registro pendiente puede superar
+    al k-ésimo mejor o cuando se agota el tiempo. Con cotas iguales
+    a 1 (margen=None en cotas_superiores) la terminación por cota solo
+    ocurre si el k-ésimo mejor llega a 1.0, por lo que en la práctica
+    la búsqueda exacta solo termina antes por tiempo; la terminación
+    por cota es útil con un margen heurístico.
+
+    Parametros
+    ----------
+    p : multiprocessing.Pool
+        Pool en el que se ejecuta func.
+    func : function
+        Función que recibe el índice de un registro y regresa su correlación.
+    orden : array_like
+        Índices de los registros, de mayor a menor cota.
+    cotas : ndarray
+        Cota superior de la correlación de cada registro.
+    k : int
+        Número de mejores resultados a conservar (al menos 1).
+    tiempo_max : float
+        Tiempo máximo de búsqueda en segundos. None para no limitarlo.
+    al_actualizar : function
+        Se llama como al_actualizar(mejores, n_procesados) cada vez
+        que cambian los k mejores.
+
+    Returns
+    -------
+    mejores : list
+        Pares (correlación, índice) ordenados de mayor a menor.
+    fin : str
+        Cómo terminó la búsqueda: 'agotada' si se procesaron todos los
+        registros, 'cota' si ningún pendiente podía superar al k-ésimo
+        (los resultados son aproximados si la cota es heurística) o
+        'tiempo' si se agotó tiempo_max.
+    n_procesados : int
+        Número de registros procesados.
+    """
+    if k < 1:
+        raise ValueError('k debe ser al menos 1: {}'.format(k))
+    orden = list(orden)
+    inicio = time.time()
+    # Montículo con los k mejores; en la raíz está el k-ésimo
+    top = []
+    terminados = set()
+    # Posición en orden del primer registro sin terminar
+    i_pend = 0
+    fin = 'agotada'
+    with limite_blas(p):
+        resultados = p.imap_unordered(_Etiquetado(func), orden)
+        while True:
+            timeout = None
+            if tiempo_max is not None:
+                timeout = tiempo_max - (time.time() - inicio)
+                if timeout <= 0:
+                    fin = 'tiempo'
+                    break
+            try:
+                i_registro, corr = resultados.next(timeout)
+            except StopIteration:
+                break
+            except mp.TimeoutError:
+                fin = 'tiempo'
+                break
+            terminados.add(i_registro)
+            corr = float(corr)
+            # Los registros sin correlación válida no entran al top
+            cambio = False
+            if np.isfinite(corr):
+                if len(top) < k:
+                    heapq.heappush(top, (corr, i_registro))
+                    cambio = True
+                elif corr > top[0][0]:
+                    heapq.heapreplace(top, (corr, i_registro))
+                    cambio = True
+            if cambio and al_actualizar is not None:
+                al_actualizar(sorted(top, reverse=True), len(terminados))
+            # Mayor cota entre los registros pendientes
+            while i_pend < len(orden) and orden[i_pend] in terminados:
+                i_pend += 1
+            if i_pend == len(orden):
+                break
+            if len(top) == k and cotas[orden[i_pend]] <= top[0][0]:
+                fin = 'cota'
+                break
+    return sorted(top, reverse=True), fin, len(terminados)
+
+
+def reporte_top(datos):
+    """
+    Función que genera una función para imprimir los mejores
+    resultados parciales de una búsqueda progresiva.
+    """
+    def imprimir(mejores, n_procesados):
+        print('--- {} registros procesados'.format(n_procesados))
+        for n, (corr, registro) in enumerate(mejores):
+            print('%2d' % (n + 1) + '. ' + datos[registro][0] + ' - %.4f' % corr)
+    return imprimir
+
+
+# Tiempo aproximado por registro, en segundos, de cada método. El
+# trabajo pesado (envelope, my_airPLS, fac_re) se hace sobre el espectro
+# de entrada recortado al dominio del registro, por lo que este tiempo
+# escala con el número de puntos de entrada dentro de ese dominio.
+# Son valores de referencia aproximados, no calibrados contra
+# comparar_SG/comparar_airPLS; conviene medirlos en el equipo de uso.
+TIEMPO_REGISTRO = {
+    'SG': 0.1,
+    'airPLS': 0.007,
+    'polinomial': 0.007
+}
+# Tiempo por punto del registro (lp y los ciclos de fix_ind), en segundos.
+# Este valor y TIEMPO_COPIA son órdenes de magnitud aproximados (un ciclo
+# de Python y una copia de memoria por elemento), no mediciones.
+TIEMPO_PUNTO_REGISTRO = 1e-6
+# Tiempo por elemento copiado al recortar el registro con np.delete al
+# final de fix_ind, en segundos
+TIEMPO_COPIA = 1e-9
+
+
+def costo_registros(x, datos, metodo):
+    """
+    Función que estima el tiempo de procesar cada registro de la
+    base de datos con el método seleccionado.
+
+    El costo tiene tres términos: el trabajo del método sobre los
+    puntos del espectro de entrada dentro del dominio del registro,
+    el filtrado y empate de índices del registro (lineal en su
+    longitud) y el recorte con np.delete de los puntos del registro
+    que sobrepasan al espectro de entrada, que copia el registro una
+    vez por cada punto recortado.
+
+    Parametros
+    ----------
+    x : ndarray
+        Dominio del espectro a analizar.
+    datos : list
+        Registros de la base de datos [nombre, x, y].
+    metodo : str
+        Método de corrección por línea base ('SG', 'airPLS' o 'polinomial').
+
+    Returns
+    -------
+    costos : ndarray
+        Tiempo estimado de cada registro en segundos.
+    """
+    x = np.sort(x)
+    x_max = x[-1]
+    # Tiempo del método por cada punto del espectro de entrada
+    tiempo_punto = TIEMPO_REGISTRO[metodo] / len(x)
+    costos = np.zeros(len(datos))
+    for i, registro in enumerate(datos):
+        xR = registro[1]
+        # Puntos del espectro de entrada en [min xR, max xR]
+        n_x = (np.searchsorted(x, np.amax(xR), side='right')
+               - np.searchsorted(x, np.amin(xR), side='left'))
+        # Puntos del registro por encima de max(x) que recorta fix_ind
+        n_sobra = len(xR) - np.searchsorted(xR, x_max, side='right')
+        costos[i] = (tiempo_punto * n_x
+                     + TIEMPO_PUNTO_REGISTRO * len(xR)
+                     + TIEMPO_COPIA * n_sobra * len(xR))
+    return costos
+
+
+def bloques_balanceados(indices, costos, n_bloques):
+    """
+    Función que reparte los registros en bloques de costo total
+    similar. Asigna cada registro, del más costoso al menos costoso,
+    al bloque con menor carga.
+
+    Returns
+    -------
+    bloques : list
+        Listas de índices, ordenadas de mayor a menor costo total.
+    """
+    indices = sorted(indices, key=lambda i: costos[i], reverse=True)
+    n_bloques = max(1, min(n_bloques, len(indices)))
+    cargas = [(0.0, b) for b in range(n_bloques)]
+    bloques = [[] for b in range(n_bloques)]
+    for i in indices:
+        carga, b = heapq.heappop(cargas)
+        bloques[b].append(i)
+        heapq.heappush(cargas, (carga + costos[i], b))
+    total = [sum(costos[i] for i in bloque) for bloque in bloques]
+    orden = np.argsort(total)[::-1]
+    return [bloques[b] for b in orden if bloques[b]]
+
+
+class _Medido:
+    """
+    Envuelve una función de comparación para procesar un bloque de
+    registros y registrar qué proceso lo atendió y cuánto tardó.
+    """
+
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, bloque):
+        t_ini = time.time()
+        resultados = [(i, self.func(i)) for i in bloque]
+        trabajador = (os.getpid(), threading.current_thread().name)
+        return resultados, trabajador, t_ini, time.time()
+
+
+def mapear_por_costo(p, func, costos, n_trabajadores, modo='mayor_primero'):
+    """
+    Función que reemplaza a Pool.map despachando primero los
+    registros más costosos para que ningún proceso termine tarde.
+
+    Parametros
+    ----------
+    p : multiprocessing.Pool
+        Pool en el que se ejecuta func.
+    func : function
+        Función que recibe el índice de un registro y regresa su correlación.
+    costos : ndarray
+        Costo estimado de cada registro (ver costo_registros).
+    n_trabajadores : int
+        Número de procesos del pool.
+    modo : str
+        'mayor_primero' despacha registro por registro de mayor a menor
+        costo; 'bloques' despacha bloques de costo similar
+        (cuatro por proceso).
+
+    Returns
+    -------
+    correlaciones : list
+        Resultado de func para cada registro, en el orden original.
+    uso : dict
+        Utilización de cada proceso (ver utilizacion).
+    """
+    n_registros = len(costos)
+    if modo == 'mayor_primero':
+        bloques = [[i] for i in np.argsort(-costos, kind='stable')]
+    elif modo == 'bloques':
+        bloques = bloques_balanceados(range(n_registros), costos,
+                                      4 * n_trabajadores)
+    else:
+        raise ValueError('Modo de despacho desconocido: {}'.format(modo))
+    correlaciones = [None] * n_registros
+    tiempos = []
+    inicio = time.time()
+    with limite_blas(p):
+        for resultados, trabajador, t_ini, t_fin in p.imap_unordered(_Medido(func), bloques):
+            for i, corr in resultados:
+                correlaciones[i] = corr
+            tiempos.append((trabajador, t_ini, t_fin))
+    return correlaciones, utilizacion(tiempos, inicio, time.time())
+
+
+def utilizacion(tiempos, inicio, fin):
+    """
+    Función que calcula la utilización de cada trabajador.
+
+    Parametros
+    ----------
+    tiempos : list
+        Tuplas (trabajador, t_ini, t_fin) de cada bloque procesado;
+        trabajador es el par (pid, nombre del hilo).
+    inicio, fin : float
+        Tiempos de inicio y fin del despacho.
+
+    Returns
+    -------
+    uso : dict
+        Para cada trabajador, la fracción del tiempo total que estuvo
+        ocupado y el tiempo que estuvo ocioso al final, en segundos.
+    """
+    total = max(fin - inicio, 1e-9)
+    ocupado = {}
+    ultimo = {}
+    for trabajador, t_ini, t_fin in tiempos:
+        ocupado[trabajador] = ocupado.get(trabajador, 0.0) + (t_fin - t_ini)
+        ultimo[trabajador] = max(ultimo.get(trabajador, inicio), t_fin)
+    return {t: (ocupado[t] / total, fin - ultimo[t]) for t in ocupado}
+
+
+def reporte_utilizacion(uso):
+    """
+    Función que imprime la utilización de cada trabajador.
+    """
+    print('Utilización por trabajador')
+    for pid, hilo in sorted(uso):
+        fraccion, ocioso = uso[(pid, hilo)]
+        print('  PID %6d %-20s: %5.1f %% ocupado, %.3f s ocioso al final'
+              % (pid, hilo, 100 * fraccion, ocioso))
+
+
+# Casi todo el tiempo por registro (TIEMPO_REGISTRO) se pasa en ciclos
+# de Python que retienen el GIL (envelope, fac_re, fix_ind), por lo que
+# los hilos no aceleran estos métodos y el modo automático solo elige
+# entre serial y procesos.
+# Costo aproximado de arrancar un pool de procesos, en segundos. Es un
+# valor provisional sin medir; junto con TIEMPO_REGISTRO solo decide
+# cuándo el modo automático usa serial en lugar de procesos.
+ARRANQUE_PROCESOS = 0.2
+
+
+class _IteradorSerial:
+    """
+    Iterador con la interfaz de IMapIterator para el pool serial.
+    """
+
+    def __init__(self, func, iterable):
+        self.func = func
+        self.iterable = iter(iterable)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.func(next(self.iterable))
+
+    def next(self, timeout=None):
+        return self.__next__()
+
+
+class PoolSerial:
+    """
+    Pool que ejecuta las tareas en el proceso principal con la misma
+    interfaz que multiprocessing.Pool.
+    """
+
+    def map(self, func, iterable, chunksize=None):
+        return [func(i) for i in iterable]
+
+    def imap_unordered(self, func, iterable, chunksize=1):
+        return _IteradorSerial(func, iterable)
+
+    def close(self):
+        pass
+
+    def terminate(self):
+        pass
+
+    def join(self):
+        pass
+
+
+class PoolHilos(ThreadPool):
+    """
+    ThreadPool que recuerda cuántos hilos de BLAS le corresponden
+    a cada trabajador (ver limite_blas).
+    """
+
+    def __init__(self, n_trabajadores, n_blas):
+        super().__init__(n_trabajadores)
+        self.n_blas = n_blas
+
+
+def limitar_blas(n_hilos):
+    """
+    Función que limita el número de hilos de BLAS/OpenMP de un
+    proceso trabajador para que no compitan por los núcleos.
+    Sin threadpoolctl solo se fijan las variables de entorno, que
+    afectan a las bibliotecas que aún no se han cargado.
+    """
+    for var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+        os.environ[var] = str(n_hilos)
+    if threadpool_limits is not None:
+        threadpool_limits(limits=n_hilos)
+
+
+def limite_blas(p):
+    """
+    Función que regresa un contexto que limita los hilos de BLAS del
+    proceso principal mientras se usa un PoolHilos. Con otros pools,
+    o sin threadpoolctl, el contexto no hace nada.
+    """
+    n_blas = getattr(p, 'n_blas', None)
+    if n_blas is None or threadpool_limits is None:
+        return contextlib.nullcontext()
+    return threadpool_limits(limits=n_blas)
+
+
+def elegir_backend(n_tareas, metodo):
+    """
+    Función que elige el backend de ejecución y el número de
+    trabajadores a partir del tamaño de la carga de trabajo.
+
+    Parametros
+    ----------
+    n_tareas : int
+        Número de registros a procesar.
+    metodo : str
+        Método de corrección por línea base ('SG', 'airPLS' o 'polinomial').
+
+    Returns
+    -------
+    backend : str
+        'serial' o 'procesos'; los hilos solo se usan si se piden.
+    n_trabajadores : int
+    """
+    n_cpu = mp.cpu_count()
+    # Si todo el trabajo cuesta menos que arrancar los procesos,
+    # conviene hacerlo en el proceso principal
+    if n_cpu == 1 or n_tareas * TIEMPO_REGISTRO[metodo] < ARRANQUE_PROCESOS:
+        return 'serial', 1
+    return 'procesos', min(n_cpu, n_tareas)
+
+
+def _iniciar_proceso(n_blas, inicializar, args):
+    # Inicialización de cada proceso trabajador
+    limitar_blas(n_blas)
+    if inicializar is not None:
+        inicializar(*args)
+
+
+def crear_pool(backend='auto', n_trabajadores=None, n_tareas=None, metodo=None,
+               inicializar=None, args=()):
+    """
+    Función que crea un pool de trabajadores con el backend indicado.
+
+    Parametros
+    ----------
+    backend : str
+        'procesos', 'hilos', 'serial' o 'auto' para elegirlo con
+        elegir_backend. Sin n_tareas o metodo, 'auto' usa procesos.
+    n_trabajadores : int
+        Número de trabajadores; None para usar uno por núcleo.
+    inicializar : function
+        Solo con procesos: se llama como inicializar(*args) al arrancar
+        cada proceso trabajador.
+
+    Returns
+    -------
+    p : Pool
+        Objeto con la interfaz de multiprocessing.Pool.
+    backend : str
+        Backend utilizado.
+    n_trabajadores : int
+        Número de trabajadores del pool.
+    """
+    if backend == 'auto' and (n_tareas is None or metodo is None):
+        backend = 'procesos'
+    elif backend == 'auto':
+        backend, n_auto = elegir_backend(n_tareas, metodo)
+        if n_trabajadores is None:
+            n_trabajadores = n_auto
+    if inicializar is not None and backend != 'procesos':
+        raise ValueError('inicializar solo se admite con procesos')
+    if backend == 'serial':
+        return PoolSerial(), backend, 1
+    if n_trabajadores is None:
+        n_trabajadores = mp.cpu_count()
+    # Repartimos los núcleos entre los trabajadores
+    n_blas = max(1, mp.cpu_count() // n_trabajadores)
+    if backend == 'procesos':
+        p = mp.Pool(n_trabajadores, initializer=_iniciar_proceso,
+                    initargs=(n_blas, inicializar, args))
+    elif backend == 'hilos':
+        # Los hilos comparten las bibliotecas del proceso principal, el
+        # límite se aplica solo mientras se usa el pool (limite_blas)
+        p = PoolHilos(n_trabajadores, n_blas)
+    else:
+        raise ValueError('Backend desconocido: {}'.format(backend))
+    return p, backend, n_trabajadores
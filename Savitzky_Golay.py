@@ -15,13 +15,13 @@ from Funcion import *
 from scipy.signal import savgol_filter
 
 
-def mp_SG(i_registro):
+def comparar_SG(x, y, xR, yR):
     # Espectro de entrada
-    x = np.copy(X)
-    y = np.copy(Y)
+    x = np.copy(x)
+    y = np.copy(y)
     # Espectros de la base de datos RRUFF
-    xR = np.copy(datos[i_registro][1])
-    yR = np.copy(datos[i_registro][2])
+    xR = np.copy(xR)
+    yR = np.copy(yR)
     # Empatar dominio de los espectros a comparar
     xc, yc, xR, yR = fix_ind(x, y, xR, yR)
     xc, yc, xR, yR = fix_ind(xc, yc, xR, yR)
@@ -57,6 +57,11 @@ def mp_SG(i_registro):
     return mycorr(xc, yc, xR, yR)
 
 
+def mp_SG(i_registro):
+    # Comparamos el espectro de entrada con un registro de la base de datos
+    return comparar_SG(X, Y, datos[i_registro][1], datos[i_registro][2])
+
+
 if __name__ == "__main__":
     plt.rcParams.update(params)
     # Ventana para pedir archivo
@@ -82,21 +87,60 @@ if __name__ == "__main__":
     # Inicializamos el arreglo para guardar los coeficientes de correlación
     correlaciones = np.zeros((n_registros, 1))
 
+    # Búsqueda progresiva: muestra los mejores resultados conforme
+    # avanza y puede terminar sin procesar toda la base de datos
+    progresiva = False
+    # Holgura sobre el puntaje burdo. None = búsqueda exacta, que solo
+    # termina antes por tiempo (la cota de 1.0 nunca detiene la búsqueda
+    # salvo que el k-ésimo mejor llegue a 1.0); con un valor numérico
+    # termina antes por cota, con resultados aproximados
+    margen = None
+    # Tiempo máximo de búsqueda en segundos (None = sin límite)
+    tiempo_max = None
+
+    # Backend de ejecución: 'auto', 'procesos', 'hilos' o 'serial'
+    backend = 'auto'
+
     # ================================================ Multiprocesamiento
-    p = mp.Pool(mp.cpu_count())
-    correlaciones = p.map(mp_SG, range(n_registros))
-    p.close()
+    p, backend, n_trabajadores = crear_pool(backend, n_tareas=n_registros,
+                                            metodo='SG')
+    print('Backend: {} con {} trabajadores'.format(backend, n_trabajadores))
+    if progresiva:
+        burdo, cotas = cotas_superiores(X, Y, datos, margen)
+        mejores, fin, n_procesados = busqueda_progresiva(
+            p, mp_SG, np.argsort(-burdo), cotas, 10, tiempo_max,
+            reporte_top(datos))
+        if fin == 'tiempo':
+            print('Búsqueda detenida por tiempo')
+        elif fin == 'cota' and margen is not None:
+            print('Búsqueda detenida por cota heurística (margen = {}); '
+                  'los resultados pueden ser aproximados'.format(margen))
+        elif fin == 'cota':
+            print('Búsqueda detenida por cota')
+        print('Registros procesados: {} de {}'.format(n_procesados, n_registros))
+        p.terminate()
+    else:
+        costos = costo_registros(X, datos, 'SG')
+        correlaciones, uso = mapear_por_costo(p, mp_SG, costos,
+                                              n_trabajadores)
+        p.close()
+        reporte_utilizacion(uso)
     p.join()
     # ================================================ Multiprocesamiento
 
     # Calculando los coeficientes de correlación más altos
     imax = []
     max = []
-    correlaciones = np.array(correlaciones)
-    for im in range(10):
-        max.append(np.amax(correlaciones))
-        imax.append(correlaciones.argmax())
-        correlaciones[imax[im]] = 0
+    if progresiva:
+        for corr, registro in mejores:
+            max.append(corr)
+            imax.append(registro)
+    else:
+        correlaciones = np.array(correlaciones)
+        for im in range(10):
+            max.append(np.amax(correlaciones))
+            imax.append(correlaciones.argmax())
+            correlaciones[imax[im]] = 0
 
     # Repetimos el procesamiento, pero esta vez, solamente para los
     # tres espectros con un mayor coeficiente de correlación.
@@ -105,7 +149,7 @@ if __name__ == "__main__":
     plt.ylabel('Intensidad [U.A.]')
     plt.xlabel('Corrimiento Raman [cm⁻¹]')
     plt.legend()
-    for n in range(3):
+    for n in range(min(3, len(imax))):
         registro = imax[n]
         corr = max[n]
         nombre = datos[registro][0]
@@ -147,7 +191,7 @@ if __name__ == "__main__":
     print("Tiempo transcurrido: %3.3f" % (end - start)+" segundos")
     print('=======================================')
     print('Resultados\n')
-    for k in range(10):
+    for k in range(len(imax)):
         k +=1
         registro = imax[k-1]
         nombre = datos[registro][0]
@@ -14,13 +14,13 @@ Supervisó: Dr. Josué Tago Pacheco
 from Funcion import *
 
 
-def mp_airPLS(i_registro):
+def comparar_airPLS(x, y, xR, yR):
     # Espectro de entrada
-    x = np.copy(X)
-    y = np.copy(Y)
+    x = np.copy(x)
+    y = np.copy(y)
     # Espectros de la base de datos RRUFF
-    xR = np.copy(datos[i_registro][1])
-    yR = np.copy(datos[i_registro][2])
+    xR = np.copy(xR)
+    yR = np.copy(yR)
     # Empatar dominio de los espectros a comparar
     xc, yc, xR, yR = fix_ind(x, y, xR, yR)
     xc, yc, xR, yR = fix_ind(xc, yc, xR, yR)
@@ -47,6 +47,11 @@ def mp_airPLS(i_registro):
     return np.array(mycorr(xc, yc, xR, yR))
 
 
+def mp_airPLS(i_registro):
+    # Comparamos el espectro de entrada con un registro de la base de datos
+    return comparar_airPLS(X, Y, datos[i_registro][1], datos[i_registro][2])
+
+
 if __name__ == "__main__":
     plt.rcParams.update(params)
     # Ventana para pedir archivo
@@ -72,21 +77,60 @@ if __name__ == "__main__":
     # Inicializamos el arreglo para guardar los coeficientes de correlación
     correlaciones = np.zeros((len(datos), 1))
 
+    # Búsqueda progresiva: muestra los mejores resultados conforme
+    # avanza y puede terminar sin procesar toda la base de datos
+    progresiva = False
+    # Holgura sobre el puntaje burdo. None = búsqueda exacta, que solo
+    # termina antes por tiempo (la cota de 1.0 nunca detiene la búsqueda
+    # salvo que el k-ésimo mejor llegue a 1.0); con un valor numérico
+    # termina antes por cota, con resultados aproximados
+    margen = None
+    # Tiempo máximo de búsqueda en segundos (None = sin límite)
+    tiempo_max = None
+
+    # Backend de ejecución: 'auto', 'procesos', 'hilos' o 'serial'
+    backend = 'auto'
+
     # ================================================ Multiprocesamiento
-    p = mp.Pool(mp.cpu_count())
-    correlaciones = p.map(mp_airPLS, range(n_registros))
-    p.close()
+    p, backend, n_trabajadores = crear_pool(backend, n_tareas=n_registros,
+                                            metodo='airPLS')
+    print('Backend: {} con {} trabajadores'.format(backend, n_trabajadores))
+    if progresiva:
+        burdo, cotas = cotas_superiores(X, Y, datos, margen)
+        mejores, fin, n_procesados = busqueda_progresiva(
+            p, mp_airPLS, np.argsort(-burdo), cotas, 20, tiempo_max,
+            reporte_top(datos))
+        if fin == 'tiempo':
+            print('Búsqueda detenida por tiempo')
+        elif fin == 'cota' and margen is not None:
+            print('Búsqueda detenida por cota heurística (margen = {}); '
+                  'los resultados pueden ser aproximados'.format(margen))
+        elif fin == 'cota':
+            print('Búsqueda detenida por cota')
+        print('Registros procesados: {} de {}'.format(n_procesados, n_registros))
+        p.terminate()
+    else:
+        costos = costo_registros(X, datos, 'airPLS')
+        correlaciones, uso = mapear_por_costo(p, mp_airPLS, costos,
+                                              n_trabajadores)
+        p.close()
+        reporte_utilizacion(uso)
     p.join()
     # ================================================ Multiprocesamiento
 
     # Calculando los coeficientes de correlación más altos
     imax = []
     max = []
-    correlaciones = np.array(correlaciones)
-    for im in range(20):
-        max.append(np.amax(correlaciones))
-        imax.append(correlaciones.argmax())
-        correlaciones[imax[im]] = 0
+    if progresiva:
+        for corr, registro in mejores:
+            max.append(corr)
+            imax.append(registro)
+    else:
+        correlaciones = np.array(correlaciones)
+        for im in range(20):
+            max.append(np.amax(correlaciones))
+            imax.append(correlaciones.argmax())
+            correlaciones[imax[im]] = 0
 
     # Repetimos el procesamiento, pero esta vez, solamente para los
     # tres espectros con un mayor coeficiente de correlación.
@@ -96,7 +140,7 @@ if __name__ == "__main__":
     plt.xlabel('Corrimiento Raman [cm⁻¹]')
     plt.legend()
 
-    for n in range(3):
+    for n in range(min(3, len(imax))):
         registro = imax[n]
         corr = max[n]
         nombre = datos[registro][0]
@@ -129,7 +173,7 @@ if __name__ == "__main__":
     print("Tiempo transcurrido: %3.3f" % (end - start)+" segundos")
     print('=======================================')
     print('Resultados\n')
-    for k in range(20):
+    for k in range(len(imax)):
         k +=1
         registro = imax[k-1]
         nombre = datos[registro][0]
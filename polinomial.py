@@ -76,14 +76,25 @@ if __name__ == "__main__":
     # Inicializamos el arreglo para guardar los coeficientes de correlación
     correlaciones = np.zeros((n_registros, grado_fin))
 
+    # Costo estimado de cada registro para repartir el trabajo
+    costos = costo_registros(X, datos, 'polinomial')
+
+    # Backend de ejecución: 'auto', 'procesos', 'hilos' o 'serial'
+    backend = 'auto'
+
     # ================================================ Multiprocesamiento
     p = []
     for j in range(grado_fin):
-        p.append(mp.Pool(mp.cpu_count()))
-        correlaciones[:, j] = p[j].map(polinomial, range(n_registros))
-        p[j].close
-        p[j].join
-        print(f"Grado: {j+1}")
+        # El pool se crea por grado para que los procesos hereden j
+        pool, backend_j, n_trabajadores = crear_pool(backend, n_tareas=n_registros,
+                                                     metodo='polinomial')
+        p.append(pool)
+        correlaciones[:, j], uso = mapear_por_costo(p[j], polinomial, costos,
+                                                    n_trabajadores)
+        p[j].close()
+        p[j].join()
+        print(f"Grado: {j+1} ({backend_j}, {n_trabajadores} trabajadores)")
+        reporte_utilizacion(uso)
     # ================================================ Multiprocesamiento
 
     # Calculando los coeficientes de correlación más altos